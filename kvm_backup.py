@@ -33,11 +33,29 @@ import logging
 import os.path
 import datetime
 import argparse
+import posixpath
+import threading
+import concurrent.futures
+import json
+import errno
+import signal
+import glob
+import functools
+try:
+    import boto3
+    import botocore.config
+    import botocore.exceptions
+except ImportError:
+    boto3 = None  # only needed for s3:// destinations
 
 
 class FatalKvmBackupException(Exception):
     pass
 
+
+class CopyFailedException(Exception):
+    pass
+
 # logging.basicConfig(filename='example.log',level=logging.DEBUG)
 logging.basicConfig(level=logging.DEBUG)
 
@@ -47,9 +65,14 @@ logging.basicConfig(level=logging.DEBUG)
 BACKUP_DST = '/tmp'
 BACKUP_SPACE_MARGIN = 10*1024**3
 BACKUP_FREE_SPACE = 0
+S3_MIN_PART_SIZE = 5*1024**2
+S3_MAX_PARTS = 10000
+S3_RETRY_ERROR_CODES = ('SlowDown', 'Throttling', 'ThrottlingException', 'RequestTimeout', 'InternalError')
 date_format = "%Y-%m-%dT%H%M%S"
 args = None
 conn = None  # connection to hypervisor
+DESTINATION = None  # LocalDestination or S3Destination
+PROFILE_SUFFIX = "_snapshot_window.json"  # <backup folder><PROFILE_SUFFIX> written by --profile
 
 import smtplib
 
@@ -73,6 +96,35 @@ def validate_blockinfo(job_info):
     return False
 
 
+def get_overlay_file(device, backup_time):
+    """return the external snapshot file that receives guest writes during backup"""
+    return "{:s}/{:s}_{:s}".format(device.file_dir, backup_time.strftime(date_format), device.file_base)
+
+
+def get_data_extents(path):
+    """return size and list of (offset, length) of the allocated data in path (holes skipped)"""
+    extents = []
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as err:
+                if err.errno == errno.ENXIO:
+                    # only a hole left
+                    break
+                # file system without SEEK_DATA, all of it is data
+                return size, [(0, size)]
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+            extents.append((start, end - start))
+            offset = end
+    finally:
+        os.close(fd)
+    return size, extents
+
+
 class Sender(object):
     """E-mail stuff to people"""
     def __init__(self):
@@ -110,6 +162,522 @@ class Device(object):
         self.allocation = allocation
 
 
+class LocalDestination(object):
+    """Backups stored in a local (or mounted) directory"""
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return self.path
+
+    def free_space(self):
+        return shutil.disk_usage(self.path).free
+
+    def join(self, *parts):
+        return os.path.join(self.path, *parts)
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def makedirs(self, path):
+        os.makedirs(path, exist_ok=True)
+
+    def mkdir(self, path):
+        os.mkdir(path)
+
+    def listdir(self, path):
+        return os.listdir(path)
+
+    def write_file(self, path, content):
+        f = open(path, 'w')
+        f.write(content)
+        f.close()
+
+    def copy_command(self, src, dst_dir):
+        return get_copy_command() + src + " " + dst_dir
+
+    @staticmethod
+    def __copied_size(src, dst_dir):
+        """bytes written so far by cp (destination file) or rsync (.<file>.XXXXXX temporary file)"""
+        base = os.path.basename(src)
+        sizes = [0]
+        for path in [os.path.join(dst_dir, base)] + glob.glob(os.path.join(glob.escape(dst_dir),
+                                                                          '.' + glob.escape(base) + '.*')):
+            try:
+                sizes.append(os.path.getsize(path))
+            except OSError:
+                pass
+        return max(sizes)
+
+    def copy_file(self, src, dst_dir, abort=None, progress=None):
+        if abort is not None and abort.is_set():
+            raise CopyFailedException("copy of {:s} aborted".format(src))
+        # own process group so the whole shell pipeline can be stopped on abort
+        proc = subprocess.Popen(self.copy_command(src, dst_dir), shell=True, start_new_session=True)
+        try:
+            while True:
+                try:
+                    proc.wait(timeout=1)
+                    break
+                except subprocess.TimeoutExpired:
+                    if abort is not None and abort.is_set():
+                        raise CopyFailedException("copy of {:s} aborted".format(src))
+                    if progress is not None:
+                        progress(self.__copied_size(src, dst_dir), os.path.getsize(src))
+        except BaseException:
+            # not in the terminal's process group, so Ctrl-C does not reach the copy
+            if proc.poll() is None:
+                try:
+                    os.killpg(proc.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+                proc.wait()
+            raise
+        if proc.returncode != 0:
+            raise CopyFailedException("Command '{:s}' returned non-zero exit status {:d}".format(
+                self.copy_command(src, dst_dir), proc.returncode))
+
+    def rmtree(self, path):
+        shutil.rmtree(path)
+
+    def remove(self, path):
+        os.remove(path)
+
+
+class S3Destination(object):
+    """Backups stored in an S3 compatible object store (s3://bucket/prefix)
+
+    Images are streamed from disk as parallel multipart uploads. At most
+    workers + 1 parts are held in memory at any time and every part is retried
+    on its own (throttling, 5xx and connection errors) before the whole upload
+    is aborted. Holes in sparse images are not uploaded, the object then holds
+    the data ranges back to back and <file>.sparsemap lists size and extents.
+    """
+    def __init__(self, url, endpoint_url=None, part_size=64*1024**2, workers=4, retries=5):
+        if boto3 is None:
+            raise FatalKvmBackupException("boto3 is required for s3 destination " + url)
+        tmp = url[len('s3://'):].split('/', 1)
+        self.url = url
+        self.bucket = tmp[0]
+        self.prefix = tmp[1].strip('/') if len(tmp) == 2 else ''
+        self.part_size = max(part_size, S3_MIN_PART_SIZE)
+        self.workers = workers
+        self.retries = retries
+        self.client = boto3.client('s3', endpoint_url=endpoint_url,
+                                   config=botocore.config.Config(max_pool_connections=workers + 1))
+
+    def __str__(self):
+        return self.url
+
+    def free_space(self):
+        # object stores do not run out of space in any way we can ask for
+        if not self.exists(self.prefix):
+            raise FileNotFoundError("s3 bucket {:s} unavailable".format(self.bucket))
+        return float('inf')
+
+    def join(self, *parts):
+        return posixpath.join(self.prefix, *parts)
+
+    def exists(self, path):
+        # there are no directories in an object store, a prefix is usable as long as the bucket is
+        try:
+            self.client.head_bucket(Bucket=self.bucket)
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as err:
+            logging.debug("s3 bucket {:s} unavailable: {:s}".format(self.bucket, str(err)))
+            return False
+        return True
+
+    def makedirs(self, path):
+        pass
+
+    def mkdir(self, path):
+        pass
+
+    def listdir(self, path):
+        """return the names directly below path (retention is done on object listing)"""
+        names = []
+        try:
+            paginator = self.client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=path.rstrip('/') + '/', Delimiter='/'):
+                for item in page.get('CommonPrefixes', []):
+                    names.append(posixpath.basename(item['Prefix'].rstrip('/')))
+                for item in page.get('Contents', []):
+                    names.append(posixpath.basename(item['Key']))
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as err:
+            raise OSError("cannot list s3://{:s}/{:s}: {:s}".format(self.bucket, path, str(err)))
+        return names
+
+    def write_file(self, path, content):
+        try:
+            self.client.put_object(Bucket=self.bucket, Key=path, Body=content.encode('utf-8'))
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as err:
+            raise OSError("cannot write s3://{:s}/{:s}: {:s}".format(self.bucket, path, str(err)))
+
+    def copy_command(self, src, dst_dir):
+        return "multipart upload {:s} to s3://{:s}/{:s} ({:s} parts, {:d} workers)".format(
+            src, self.bucket, posixpath.join(dst_dir, os.path.basename(src)),
+            sizeof_fmt(self.part_size), self.workers)
+
+    @staticmethod
+    def __retryable(err):
+        if isinstance(err, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)):
+            return True
+        if isinstance(err, botocore.exceptions.ClientError):
+            status = err.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+            code = err.response.get('Error', {}).get('Code', '')
+            return status >= 500 or status == 429 or code in S3_RETRY_ERROR_CODES
+        return False
+
+    def __upload_part(self, key, upload_id, part_number, chunk):
+        attempt = 0
+        while True:
+            try:
+                ret = self.client.upload_part(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                              PartNumber=part_number, Body=chunk)
+                return {'PartNumber': part_number, 'ETag': ret['ETag']}
+            except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as err:
+                attempt += 1
+                if attempt > self.retries or not self.__retryable(err):
+                    raise
+                logging.debug("upload of part {:d} of {:s} failed (attempt {:d}): {:s}".format(
+                    part_number, key, attempt, str(err)))
+                time.sleep(2**attempt)
+
+    @staticmethod
+    def __read_extents(f, extents, part_size):
+        """yield part_size chunks of the data in extents"""
+        buf = bytearray()
+        for offset, length in extents:
+            f.seek(offset)
+            while length > 0:
+                data = f.read(min(length, part_size - len(buf)))
+                if not data:
+                    break
+                buf += data
+                length -= len(data)
+                if len(buf) == part_size:
+                    yield bytes(buf)
+                    buf = bytearray()
+        if buf:
+            yield bytes(buf)
+
+    def copy_file(self, src, dst_dir, abort=None, progress=None):
+        key = posixpath.join(dst_dir, os.path.basename(src))
+        try:
+            size, extents = get_data_extents(src)
+            data_size = sum(length for offset, length in extents)
+            sparse = data_size != size
+            if sparse:
+                logging.debug("{:s} is sparse, uploading {:s} of {:s}".format(
+                    src, sizeof_fmt(data_size), sizeof_fmt(size)))
+            if data_size == 0:
+                self.client.put_object(Bucket=self.bucket, Key=key, Body=b'')
+            else:
+                self.__upload(src, key, extents, data_size, abort, progress)
+            if sparse:
+                # written last so a map always belongs to a complete object
+                sparse_map = {'size': size, 'extents': extents}
+                self.client.put_object(Bucket=self.bucket, Key=key + '.sparsemap',
+                                       Body=json.dumps(sparse_map).encode('utf-8'))
+        except (OSError, botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as err:
+            raise CopyFailedException("upload of {:s} to s3://{:s}/{:s} failed: {:s}".format(
+                src, self.bucket, key, str(err)))
+
+    def __upload(self, src, key, extents, data_size, abort, progress):
+        global args
+        upload_id = None
+        try:
+            # stay below the maximum number of parts for very large images
+            part_size = max(self.part_size, -(-data_size // S3_MAX_PARTS))
+            upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=key)['UploadId']
+            in_flight = threading.BoundedSemaphore(self.workers + 1)
+            failed = threading.Event()
+
+            def part_done(fut):
+                if not fut.cancelled() and fut.exception() is not None:
+                    failed.set()
+                in_flight.release()
+
+            futures = []
+            start_time = time.time()
+            sent = 0
+            with open(src, 'rb') as f, concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+                chunks = self.__read_extents(f, extents, part_size)
+                part_number = 1
+                while True:
+                    in_flight.acquire()
+                    if failed.is_set():
+                        in_flight.release()
+                        break
+                    if abort is not None and abort.is_set():
+                        in_flight.release()
+                        raise OSError("upload aborted")
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        in_flight.release()
+                        break
+                    fut = pool.submit(self.__upload_part, key, upload_id, part_number, chunk)
+                    fut.add_done_callback(part_done)
+                    futures.append(fut)
+                    part_number += 1
+                    sent += len(chunk)
+                    if progress is not None:
+                        progress(sent, data_size)
+                    if args.rate > 0:
+                        # keep the average rate below the bandwith limit
+                        ahead = sent / (args.rate*1024**2) - (time.time() - start_time)
+                        if ahead > 0:
+                            time.sleep(ahead)
+                parts = [fut.result() for fut in futures]
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                                  MultipartUpload={'Parts': parts})
+        except (OSError, botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError):
+            if upload_id is not None:
+                try:
+                    self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+                except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError):
+                    send_error("Cannot abort multipart upload s3://{:s}/{:s}".format(self.bucket, key))
+            raise
+
+    def rmtree(self, path):
+        try:
+            paginator = self.client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=path.rstrip('/') + '/'):
+                objects = [{'Key': item['Key']} for item in page.get('Contents', [])]
+                if objects:
+                    # a page holds at most 1000 keys which is also the delete_objects limit
+                    self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': objects, 'Quiet': True})
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as err:
+            raise PermissionError("cannot remove s3://{:s}/{:s}: {:s}".format(self.bucket, path, str(err)))
+
+    def remove(self, path):
+        try:
+            self.client.delete_object(Bucket=self.bucket, Key=path)
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as err:
+            raise PermissionError("cannot remove s3://{:s}/{:s}: {:s}".format(self.bucket, path, str(err)))
+
+
+def get_destination(dest):
+    global args
+    if dest.startswith('s3://'):
+        return S3Destination(dest, endpoint_url=args.s3_endpoint_url, part_size=args.s3_part_size*1024**2,
+                             workers=args.s3_workers)
+    return LocalDestination(dest)
+
+
+class SnapshotWindowProfiler(object):
+    """Sample overlay growth and blockcommit progress from snapshot until pivot
+
+    A background thread records the overlay file size and blockJobInfo cur/end
+    of every disk each interval. Dom reports copy progress, polls commit
+    progress every 0.1s until the job is ready for pivot and reports when the
+    pivot is done, so those times are not rounded to the sample interval.
+    The predicted overlay size is the current size plus the growth rate times
+    the time left until the disk pivots: the remaining commit at the current
+    commit speed once the commit runs, otherwise the bytes still to copy (of
+    this and earlier disks) at the measured copy rate plus committing the
+    overlays of this and earlier disks at the measured commit rate (the copy
+    rate until a commit has finished). When the prediction passes
+    overlay_limit a warning is sent, and with overlay_abort the abort event is
+    set so the image copies are stopped and the commit of all remaining disks
+    is started at once.
+    """
+    def __init__(self, dom, backup_time, interval=5, overlay_limit=0, overlay_abort=False):
+        self.dom = dom
+        self.backup_time = backup_time
+        self.interval = interval
+        self.overlay_limit = overlay_limit
+        self.overlay_abort = overlay_abort
+        self.abort = threading.Event()
+        self.start_time = None
+        self.events = {}
+        self.samples = []
+        self.disks = {}
+        for device in dom.devices:
+            self.disks[device.dev] = {'overlay': get_overlay_file(device, backup_time), 'overlay_max': 0,
+                                      'allocation': device.allocation, 'copy_start': None, 'copy_end': None,
+                                      'copy_fraction': 0, 'copy_progress': None, 'commit_end': 0, 'commit_start': None,
+                                      'commit_ready': None, 'pivot_requested': None, 'pivot_done': None,
+                                      'finished': False, 'first': None, 'last': None, 'warned': False}
+        self.__stopping = threading.Event()
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    def __elapsed(self):
+        return time.time() - self.start_time
+
+    def start(self):
+        self.start_time = time.time()
+        self.__thread = threading.Thread(target=self.__run, name="profiler " + self.dom.dom.name())
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        if self.__thread is not None:
+            self.__stopping.set()
+            self.__thread.join(self.interval + 5)
+            self.__thread = None
+
+    def event(self, name, dev=None):
+        with self.__lock:
+            if dev is None:
+                self.events[name] = self.__elapsed()
+            else:
+                self.disks[dev][name] = self.__elapsed()
+
+    def commit_progress(self, dev, cur, end):
+        """record blockJobInfo of the active commit as polled by Dom.blockcommit"""
+        with self.__lock:
+            disk = self.disks[dev]
+            disk['commit_end'] = max(disk['commit_end'], end)
+            if end > 0 and cur == end and disk['commit_ready'] is None:
+                disk['commit_ready'] = self.__elapsed()
+
+    def copy_progress(self, dev, done, total):
+        """record how much of the image copy is done (any unit, done of total)"""
+        with self.__lock:
+            self.disks[dev]['copy_fraction'] = min(float(done) / total, 1.0) if total else 1.0
+            self.disks[dev]['copy_progress'] = self.__elapsed()
+
+    def finish(self, dev):
+        """the disk is no longer on its overlay (or will not be waited for), stop sampling it"""
+        with self.__lock:
+            self.disks[dev]['finished'] = True
+
+    def __run(self):
+        while not self.__stopping.is_set():
+            try:
+                self.__sample()
+            except Exception as err:
+                logging.debug("profiler sample failed: " + str(err))
+            self.__stopping.wait(self.interval)
+
+    def __sample(self):
+        for device in self.dom.devices:
+            with self.__lock:
+                disk = self.disks[device.dev]
+                if disk['finished']:
+                    continue
+            try:
+                size = os.path.getsize(disk['overlay'])
+            except OSError:
+                # not created yet or already removed
+                continue
+            cur = end = 0
+            try:
+                job_info = self.dom.dom.blockJobInfo(device.dev)
+                if validate_blockinfo(job_info):
+                    cur = job_info['cur']
+                    end = job_info['end']
+            except libvirt.libvirtError:
+                pass
+            now = self.__elapsed()
+            with self.__lock:
+                self.samples.append([round(now, 2), device.dev, size, cur, end])
+                disk['overlay_max'] = max(disk['overlay_max'], size)
+                predicted = self.__predict(disk, now, size, cur, end)
+                disk['last'] = (now, size, cur)
+                if disk['first'] is None:
+                    disk['first'] = (now, size)
+            if self.overlay_limit and predicted > self.overlay_limit and not disk['warned']:
+                disk['warned'] = True
+                msg = "overlay {:s} predicted to grow to {:s} (limit {:s}) for {:s}".format(
+                    disk['overlay'], sizeof_fmt(predicted), sizeof_fmt(self.overlay_limit), self.dom.dom.name())
+                logging.warning(msg)
+                if self.overlay_abort:
+                    msg += ", aborting backup"
+                    self.abort.set()
+                send_error(msg)
+
+    def __copy_rate(self):
+        done = 0
+        busy = 0
+        for disk in self.disks.values():
+            if disk['copy_start'] is not None and disk['copy_progress'] is not None:
+                # up to the last progress report, that is when copy_fraction was measured
+                busy += disk['copy_progress'] - disk['copy_start']
+                done += disk['allocation'] * disk['copy_fraction']
+        if done > 0 and busy > 0:
+            return done / busy
+        return None
+
+    def __commit_rate(self):
+        done = 0
+        busy = 0
+        for disk in self.disks.values():
+            if disk['commit_start'] is not None and disk['commit_ready'] is not None:
+                done += disk['commit_end']
+                busy += disk['commit_ready'] - disk['commit_start']
+        if done > 0 and busy > 0:
+            return done / busy
+        return None
+
+    def __remaining(self, disk, now, size, cur, end):
+        """return expected seconds until disk pivots"""
+        last_time, last_size, last_cur = disk['last']
+        if end > cur > last_cur and now > last_time:
+            return (end - cur) / ((cur - last_cur) / (now - last_time))
+        copy_rate = self.__copy_rate()
+        if copy_rate is None:
+            # nothing measured yet, assume the window lasts as long again
+            return now
+        commit_rate = self.__commit_rate() or copy_rate
+        remaining = 0
+        # disks are copied and committed one after the other in device order
+        for device in self.dom.devices:
+            other = self.disks[device.dev]
+            if not other['finished']:
+                if other['copy_end'] is None:
+                    remaining += other['allocation'] * (1 - other['copy_fraction']) / copy_rate
+                if other['commit_ready'] is None:
+                    overlay = size if other is disk else (other['last'][1] if other['last'] else 0)
+                    remaining += overlay / commit_rate
+            if other is disk:
+                break
+        return remaining
+
+    def __predict(self, disk, now, size, cur, end):
+        if disk['first'] is None or now <= disk['first'][0]:
+            return size
+        growth = (size - disk['first'][1]) / (now - disk['first'][0])
+        return size + growth * max(self.__remaining(disk, now, size, cur, end), 0)
+
+    def summary(self):
+        """return the profile with per disk commit rate (bytes/s) and pivot latency (s)"""
+        with self.__lock:
+            disks = {}
+            for dev, disk in self.disks.items():
+                commit_rate = None
+                ready = disk['commit_ready'] if disk['commit_ready'] is not None else disk['pivot_requested']
+                if disk['commit_end'] > 0 and disk['commit_start'] is not None and ready is not None \
+                        and ready > disk['commit_start']:
+                    commit_rate = disk['commit_end'] / (ready - disk['commit_start'])
+                pivot_latency = None
+                if disk['pivot_requested'] is not None and disk['pivot_done'] is not None:
+                    pivot_latency = max(disk['pivot_done'] - disk['pivot_requested'], 0)
+                disks[dev] = {'overlay': disk['overlay'], 'overlay_max': disk['overlay_max'],
+                              'copy_start': disk['copy_start'], 'copy_end': disk['copy_end'],
+                              'commit_start': disk['commit_start'], 'commit_ready': disk['commit_ready'],
+                              'commit_end': disk['commit_end'], 'pivot_requested': disk['pivot_requested'],
+                              'pivot_done': disk['pivot_done'], 'commit_rate': commit_rate,
+                              'pivot_latency': pivot_latency}
+            frozen = None
+            if 'frozen' in self.events and 'thawed' in self.events:
+                frozen = self.events['thawed'] - self.events['frozen']
+            snapshot_create = None
+            if 'snapshot_create_start' in self.events and 'snapshot_create_end' in self.events:
+                snapshot_create = self.events['snapshot_create_end'] - self.events['snapshot_create_start']
+            return {'domain': self.dom.dom.name(), 'start': self.backup_time.strftime(date_format),
+                    'interval': self.interval, 'overlay_limit': self.overlay_limit,
+                    'aborted': self.abort.is_set(), 'events': dict(self.events), 'frozen': frozen,
+                    'snapshot_create': snapshot_create, 'disks': disks,
+                    'samples_columns': ['time', 'dev', 'overlay_size', 'cur', 'end'],
+                    'samples': list(self.samples)}
+
+    def write(self, path):
+        DESTINATION.write_file(path, json.dumps(self.summary(), indent=1))
+
+
 class Dom(object):
     def __init__(self, dom):
         self.dom = dom
@@ -120,6 +688,7 @@ class Dom(object):
         self.libvirt_label = None
         self.backup_start_time = None
         self.backup_end_time = None
+        self.profiler = None  # SnapshotWindowProfiler during live backup
         self.__get_target_devices()
 
     def __disable_apparmor(self):
@@ -198,13 +767,13 @@ class Dom(object):
 
     def __get_existing_backups(self):
         backups = []
-        global BACKUP_DST
+        global DESTINATION
         global args
-        backup_dst_mine = os.path.join(BACKUP_DST, self.dom.name())
+        backup_dst_mine = DESTINATION.join(self.dom.name())
         try:
             if not args.dryrun:
-                os.makedirs(backup_dst_mine, exist_ok=True)
-            dir_content = os.listdir(backup_dst_mine)
+                DESTINATION.makedirs(backup_dst_mine)
+            dir_content = DESTINATION.listdir(backup_dst_mine)
             dir_content.sort(reverse=True)
             for i, item in enumerate(dir_content):
                 try:
@@ -219,6 +788,33 @@ class Dom(object):
             raise FatalKvmBackupException(err)
         return backups
 
+    def __copy(self, device, backup_dir):
+        if self.profiler is None:
+            DESTINATION.copy_file(device.file, backup_dir)
+            return
+        self.profiler.event('copy_start', device.dev)
+        try:
+            DESTINATION.copy_file(device.file, backup_dir, self.profiler.abort,
+                                  functools.partial(self.profiler.copy_progress, device.dev))
+            self.profiler.copy_progress(device.dev, 1, 1)
+        finally:
+            self.profiler.event('copy_end', device.dev)
+
+    def __end_profiling(self, profile_file):
+        global args
+        self.profiler.stop()
+        summary = self.profiler.summary()
+        for dev, disk in summary['disks'].items():
+            logging.info("snapshot window {:s} {:s}: overlay max:{:s} commit rate:{:s}/s pivot latency:{:s}s".format(
+                self.dom.name(), dev, sizeof_fmt(disk['overlay_max']),
+                sizeof_fmt(disk['commit_rate']) if disk['commit_rate'] is not None else '-',
+                "{:.1f}".format(disk['pivot_latency']) if disk['pivot_latency'] is not None else '-'))
+        if args.profile:
+            try:
+                self.profiler.write(profile_file)
+            except OSError as err:
+                send_error("Cannot write snapshot window profile {:s} {:s}".format(profile_file, str(err)))
+
     def shutdown(self):
         return self.dom.shutdownFlags(libvirt.VIR_DOMAIN_SHUTDOWN_GUEST_AGENT)
 
@@ -276,9 +872,7 @@ class Dom(object):
         disks = ElementTree.SubElement(root, 'disks')
 
         for device in self.devices:
-            tmp_snapshot_filename = "{:s}/{:s}_{:s}".format(device.file_dir,
-                                                            backup_time.strftime(date_format),
-                                                            device.file_base)
+            tmp_snapshot_filename = get_overlay_file(device, backup_time)
             disk = ElementTree.SubElement(disks, 'disk')
             disk.set('name', device.dev)
             disk.set('snapshot', 'external')
@@ -301,40 +895,85 @@ class Dom(object):
             print(snapshot_xml)
             # raise libvirt.libvirtError('test')
         else:
-            snap = self.dom.snapshotCreateXML(
-                snapshot_xml,
-                flags=libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_QUIESCE |
-                libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA |
-                libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY |
-                libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC)
+            flags = libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA | \
+                libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY | \
+                libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC
+            if self.profiler:
+                # freeze and thaw ourselves instead of QUIESCE so the profile gets the real times
+                self.profiler.event('freeze')
+                self.dom.fsFreeze()
+                self.profiler.event('frozen')
+                try:
+                    self.profiler.event('snapshot_create_start')
+                    snap = self.dom.snapshotCreateXML(snapshot_xml, flags=flags)
+                    self.profiler.event('snapshot_create_end')
+                finally:
+                    self.profiler.event('thaw')
+                    self.dom.fsThaw()
+                    self.profiler.event('thawed')
+            else:
+                snap = self.dom.snapshotCreateXML(
+                    snapshot_xml,
+                    flags=libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_QUIESCE | flags)
         return snap
 
-    def blockcommit(self, device, backup_time):
-        global args
-        global date_format
-
+    def start_blockcommit(self, device):
         disk = device.dev
         base = None  # will be the bottom of the chain
         top = None  # the active image at the top of the chain will be used
         self.dom.blockCommit(disk, base, top,
                              flags=libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE)
+        if self.profiler:
+            self.profiler.event('commit_start', disk)
         # libvirt.VIR_DOMAIN_BLOCK_COMMIT_DELETE # not possible with leaving job running
+
+    def __wait_for_pivot(self, device, tmp_snapshot_filename, timeout=20):
+        """return true when the disk is no longer running on the temporary snapshot file"""
+        timeout_pivot = datetime.datetime.now() + datetime.timedelta(seconds=timeout)
+        while datetime.datetime.now() < timeout_pivot:
+            try:
+                if self.get_current_file(device.dev) != tmp_snapshot_filename:
+                    return True
+            except libvirt.libvirtError:
+                pass
+            time.sleep(0.1)
+        return False
+
+    def blockcommit(self, device, backup_time, started=False):
+        global args
+        global date_format
+
+        disk = device.dev
+        if not started:
+            self.start_blockcommit(device)
         timeout_time = datetime.datetime.now() + datetime.timedelta(minutes=args.timeout)
         while True:
             try:
                 job_info = self.dom.blockJobInfo(disk)
-                if validate_blockinfo(job_info):
+                pause = 1
+                if validate_blockinfo(job_info) and job_info['cur'] != job_info['end']:
+                    # not ready for pivot, poll often so the profile sees when it is
+                    if self.profiler:
+                        self.profiler.commit_progress(disk, job_info['cur'], job_info['end'])
+                    pause = 0.1
+                elif validate_blockinfo(job_info):
                     logging.debug("blockjob running: " + str(job_info))
+                    if self.profiler:
+                        self.profiler.commit_progress(disk, job_info['cur'], job_info['end'])
                     ret = self.dom.blockJobAbort(
                         disk,
                         flags=libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_ASYNC |
                         libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
                     if ret == 0:
+                        tmp_snapshot_filename = get_overlay_file(device, backup_time)
+                        if self.profiler:
+                            self.profiler.event('pivot_requested', disk)
+                            if self.__wait_for_pivot(device, tmp_snapshot_filename):
+                                self.profiler.event('pivot_done', disk)
+                            # stop sampling the overlay even if the pivot was not seen
+                            self.profiler.finish(disk)
                         if args.remove_tmp_file:
                             # remove the temporary image when blockcommit is done
-                            tmp_snapshot_filename = "{:s}/{:s}_{:s}".format(
-                                device.file_dir, backup_time.strftime(date_format), device.file_base)
-
                             timeout_file_remove = datetime.datetime.now() + datetime.timedelta(seconds=20)
                             while datetime.datetime.now() < timeout_file_remove:
                                 logging.debug("blockcommit: done remove tmp file:" + tmp_snapshot_filename + " current is:" +
@@ -361,20 +1000,20 @@ class Dom(object):
                     raise FatalKvmBackupException("Timeout in blockcommit for {:s} {:s} (minutes {:d})".format(
                         self.dom.name(), device.dev, args.timeout
                     ))
-                time.sleep(1)
+                time.sleep(pause)
             except libvirt.libvirtError as err:
                 logging.debug("blockcommit: waiting for pivot " + str(err))
                 time.sleep(5)
 
     def begin_backup(self):
-        global BACKUP_DST
+        global DESTINATION
         global args
         global date_format
 
         # used to check that the destionation is available before starting backup
         self.__get_existing_backups()
-        backup_dst_mine = os.path.join(BACKUP_DST, self.dom.name())  # this destination must exist now !
-        if os.path.exists(backup_dst_mine):
+        backup_dst_mine = DESTINATION.join(self.dom.name())  # this destination must exist now !
+        if DESTINATION.exists(backup_dst_mine):
             # directory exists and we already know there is space in the main BACKUP_DST from dom loading
             backup_time = datetime.datetime.now()
             self.backup_start_time = backup_time
@@ -393,11 +1032,10 @@ class Dom(object):
                         for device in self.devices:
                                 # check that we are running on new file
                                 current_file = self.get_current_file(device.dev)
-                                print("** run " + get_copy_command() + device.file + " " + backup_dir)
+                                print("** run " + DESTINATION.copy_command(device.file, backup_dir))
                                 if current_file != device.file:
                                     # copy the original file
-                                    subprocess.check_call(get_copy_command() + device.file +
-                                                          " " + backup_dir, shell=True)
+                                    DESTINATION.copy_file(device.file, backup_dir)
                                 print("** doing self.blockcommit(device)")
                     except libvirt.libvirtError as err:
                         # cleanup the device copy process
@@ -414,12 +1052,16 @@ class Dom(object):
                     self.cleanup_backup()
                 else:
                     self.__disable_apparmor()      # must be done on current ubuntu
-                    os.mkdir(backup_dir)
+                    DESTINATION.mkdir(backup_dir)
                     # copy xml
-                    f = open(backup_xml_file, 'w')
-                    f.write(self.persistent_xml)
-                    f.close()
+                    DESTINATION.write_file(backup_xml_file, self.persistent_xml)
                     device = None
+                    abort = None
+                    if args.profile or args.overlay_limit > 0:
+                        self.profiler = SnapshotWindowProfiler(self, backup_time, args.profile_interval,
+                                                               args.overlay_limit*1024**2, args.overlay_abort)
+                        self.profiler.start()
+                        abort = self.profiler.abort
                     try:
                         logging.debug("starting snapshot(s) for " + self.dom.name() + " " +
                                       ' '.join(map(lambda x: x.file_base, self.devices)))
@@ -431,18 +1073,33 @@ class Dom(object):
                             backup_completed_successfully = False
                         else:
                             libvirt_errors = []
-                            for device in self.devices:
+                            for i, device in enumerate(self.devices):
                                 # check that we are running on new file
                                 current_file = self.get_current_file(device.dev)
-                                logging.debug("** run " + get_copy_command() + device.file + " " + backup_dir)
+                                logging.debug("** run " + DESTINATION.copy_command(device.file, backup_dir))
                                 try:
                                     if current_file != device.file:
-                                        subprocess.check_call(get_copy_command() +
-                                                              device.file + " " + backup_dir, shell=True)
-                                except subprocess.CalledProcessError as err:
+                                        self.__copy(device, backup_dir)
+                                except CopyFailedException as err:
                                     backup_completed_successfully = False
                                     print("ERROR: file copy process failed {:s}".format(str(err)))
                                     send_error("file copy process failed {:s}".format(str(err)))
+                                if abort is not None and abort.is_set():
+                                    # overlay limit passed, start commit of all remaining disks before waiting
+                                    backup_completed_successfully = False
+                                    started = []
+                                    for device in self.devices[i:]:
+                                        try:
+                                            self.start_blockcommit(device)
+                                            started.append(device)
+                                        except libvirt.libvirtError as err:
+                                            libvirt_errors.append(err)
+                                    for device in started:
+                                        try:
+                                            self.blockcommit(device, backup_time, started=True)
+                                        except libvirt.libvirtError as err:
+                                            libvirt_errors.append(err)
+                                    break
                                 logging.debug("** doing self.blockcommit(device) device=" + device.dev)
                                 try:
                                     self.blockcommit(device, backup_time)
@@ -464,23 +1121,28 @@ class Dom(object):
                                     self.blockcommit(device, backup_time)
                         raise FatalKvmBackupException(err)
 
-                    self.cleanup_backup()
+                    if backup_completed_successfully:
+                        # a failed backup must not push a good one out of --keep
+                        self.cleanup_backup()
             except OSError as err:
                 backup_completed_successfully = False
                 # send_error("cannot create backup directory {:s}".format(str(err)))
                 raise FatalKvmBackupException(err)
             finally:
+                if self.profiler:
+                    # next to the backup folder so it is kept when a failed backup is removed
+                    self.__end_profiling(backup_dir + PROFILE_SUFFIX)
                 if not args.dryrun:
                     self.__enable_apparmor()
                 self.backup_end_time = datetime.datetime.now()
                 if not backup_completed_successfully:
                     # cleanup files for this failed backup
-                    if os.path.exists(backup_dir):
+                    if DESTINATION.exists(backup_dir):
                         if args.dryrun:
                             print("** will remove:" + backup_dir)
                         else:
                             try:
-                                shutil.rmtree(backup_dir)
+                                DESTINATION.rmtree(backup_dir)
                             except (PermissionError, FileNotFoundError):
                                 send_error("Cannot remove backup folder " + backup_dir)
                     send_error("backup failed for {:s} in backup directory:{:s}".format(self.dom.name(), backup_dir),
@@ -501,15 +1163,15 @@ class Dom(object):
             send_error("backup destination unavailable ({:s})".format(backup_dst_mine))
 
     def begin_offline_backup(self):
-        global BACKUP_DST
+        global DESTINATION
         global args
         global date_format
 
         # used to check that the destionation is available before starting backup
         self.__get_existing_backups()
-        backup_dst_mine = os.path.join(BACKUP_DST, self.dom.name())  # this destination must exist now !
+        backup_dst_mine = DESTINATION.join(self.dom.name())  # this destination must exist now !
         backup_dir = None  # in case backup fails and this is not None cleanup files
-        if os.path.exists(backup_dst_mine):
+        if DESTINATION.exists(backup_dst_mine):
             # directory exists and we already know there is space in the main BACKUP_DST from dom loading
             backup_time = datetime.datetime.now()
             self.backup_start_time = backup_time
@@ -521,19 +1183,16 @@ class Dom(object):
                     print("** will create " + backup_dir)
                     print("** save xml to " + backup_xml_file)
                     for device in self.devices:
-                            print("** run " + get_copy_command() + device.file + " " + backup_dir)
+                            print("** run " + DESTINATION.copy_command(device.file, backup_dir))
                 else:
-                    os.mkdir(backup_dir)
+                    DESTINATION.mkdir(backup_dir)
                     # copy xml
-                    f = open(backup_xml_file, 'w')
-                    f.write(self.persistent_xml)
-                    f.close()
+                    DESTINATION.write_file(backup_xml_file, self.persistent_xml)
                     for device in self.devices:
-                        logging.debug("** run " + get_copy_command() + device.file + " " + backup_dir)
+                        logging.debug("** run " + DESTINATION.copy_command(device.file, backup_dir))
                         try:
-                            subprocess.check_call(get_copy_command() +
-                                                  device.file + " " + backup_dir, shell=True)
-                        except subprocess.CalledProcessError as err:
+                            DESTINATION.copy_file(device.file, backup_dir)
+                        except CopyFailedException as err:
                             backup_completed_successfully = False
                             print("ERROR: file copy process failed {:s}".format(str(err)))
                             send_error("file copy process failed {:s}".format(str(err)))
@@ -545,12 +1204,12 @@ class Dom(object):
                 self.backup_end_time = datetime.datetime.now()
                 if not backup_completed_successfully:
                     # cleanup files for this failed backup
-                    if os.path.exists(backup_dir):
+                    if DESTINATION.exists(backup_dir):
                         if args.dryrun:
                             print("** will remove:" + backup_dir)
                         else:
                             try:
-                                shutil.rmtree(backup_dir)
+                                DESTINATION.rmtree(backup_dir)
                             except (PermissionError, FileNotFoundError):
                                 send_error("Cannot remove backup folder " + backup_dir)
                     send_error("backup failed for {:s} in backup directory:{:s}".format(self.dom.name(), backup_dir),
@@ -573,10 +1232,10 @@ class Dom(object):
 
     def cleanup_backup(self):
         global args
-        global BACKUP_DST
+        global DESTINATION
         global date_format
-        backup_dst_mine = os.path.join(BACKUP_DST, self.dom.name())  # this destination must exist now !
-        if os.path.exists(backup_dst_mine):
+        backup_dst_mine = DESTINATION.join(self.dom.name())  # this destination must exist now !
+        if DESTINATION.exists(backup_dst_mine):
             # directory exists and we already know there is space in the main BACKUP_DST from dom loading
             all_backups = self.__get_existing_backups()
             if len(all_backups) > args.keep:
@@ -587,9 +1246,28 @@ class Dom(object):
                         print("** will remove:" + backup_dir)
                     else:
                         try:
-                            shutil.rmtree(backup_dir)
+                            DESTINATION.rmtree(backup_dir)
                         except (PermissionError, FileNotFoundError):
                             send_error("Cannot remove backup folder " + backup_dir)
+            if 0 < args.keep <= len(all_backups):
+                # profiles are kept for failed backups too, remove those older than the oldest backup kept
+                oldest_kept = all_backups[args.keep - 1]
+                for item in DESTINATION.listdir(backup_dst_mine):
+                    if not item.endswith(PROFILE_SUFFIX):
+                        continue
+                    try:
+                        profile_time = datetime.datetime.strptime(item[:-len(PROFILE_SUFFIX)], date_format)
+                    except ValueError:
+                        continue
+                    if profile_time < oldest_kept:
+                        profile_file = os.path.join(backup_dst_mine, item)
+                        if args.dryrun:
+                            print("** will remove:" + profile_file)
+                        else:
+                            try:
+                                DESTINATION.remove(profile_file)
+                            except (PermissionError, FileNotFoundError):
+                                send_error("Cannot remove profile " + profile_file)
 
 
 def send_error(msg, subject=None):
@@ -603,7 +1281,8 @@ def send_error(msg, subject=None):
 
 def parse_arguments(myargs):
     parser = argparse.ArgumentParser()
-    parser.add_argument("-d", "--dest", type=str, default='/tmp', help="Backup destination folder")
+    parser.add_argument("-d", "--dest", type=str, default='/tmp',
+                        help="Backup destination folder or s3://bucket/prefix for an S3 compatible object store")
     parser.add_argument("-k", "--keep", type=int, default=2, help="Number of backups to keep")
     parser.add_argument("-r", "--rate", type=int, default=0, help="bandwith limit in MiB/s ex. 20")
     parser.add_argument("-t", "--timeout", type=int, default=60,
@@ -615,15 +1294,34 @@ def parse_arguments(myargs):
                                                                 'This option can be used multiple times')
     parser.add_argument("--noactive",  action="store_true", help='do not perform perform backup if host is on')
     parser.add_argument("--force_noactive",  action="store_true", help='shutdown vm and do offline backup')
+    parser.add_argument("--profile",  action="store_true",
+                        help='save overlay size and blockcommit progress from snapshot to pivot next to the backup')
+    parser.add_argument("--profile_interval", type=int, default=5, help='seconds between profile samples')
+    parser.add_argument("--overlay_limit", type=int, default=0,
+                        help='warn if an overlay is predicted to grow beyond this size in MiB (0 no limit)')
+    parser.add_argument("--overlay_abort",  action="store_true",
+                        help='stop copying and commit all remaining disks at once when --overlay_limit is passed')
+    parser.add_argument("--s3_endpoint_url", type=str, default=None,
+                        help='endpoint of the S3 compatible object store ex. http://minio.example.com:9000')
+    parser.add_argument("--s3_part_size", type=int, default=64, help='multipart upload part size in MiB (min 5)')
+    parser.add_argument("--s3_workers", type=int, default=4, help='number of parts uploaded in parallel')
     parser.add_argument('vms', metavar='vms', nargs='+', help='virtual machines to backup')
-    return parser.parse_args(myargs)
+    parsed = parser.parse_args(myargs)
+    if parsed.overlay_abort and parsed.overlay_limit <= 0:
+        parser.error("--overlay_abort requires --overlay_limit")
+    if parsed.profile_interval < 1:
+        parser.error("--profile_interval must be at least 1 second")
+    return parsed
 
 if __name__ == "__main__":
     args = parse_arguments(sys.argv[1:])
     BACKUP_DST = args.dest
     try:
-        tmp = shutil.disk_usage(BACKUP_DST)
-        BACKUP_FREE_SPACE = tmp.free
+        DESTINATION = get_destination(BACKUP_DST)
+        BACKUP_FREE_SPACE = DESTINATION.free_space()
+    except FatalKvmBackupException as err:
+        send_error(str(err))
+        sys.exit(1)
     except FileNotFoundError:
         send_error("Backup destination insufficient resources: {:s}".format(BACKUP_DST))
         sys.exit(1)
@@ -0,0 +1,148 @@
+"""S3Destination against a moto stand-in for the object store"""
+import json
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("libvirt")
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+import botocore.exceptions
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import kvm_backup
+
+BUCKET = 'kvmbackup-test'
+MiB = 1024**2
+
+
+@pytest.fixture
+def dest(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setattr(kvm_backup, 'args', kvm_backup.parse_arguments(['-d', 's3://{:s}/kvm'.format(BUCKET), 'vm']))
+    mails = []
+    monkeypatch.setattr(kvm_backup, 'send_error', lambda msg, subject=None: mails.append(msg))
+    monkeypatch.setattr(kvm_backup.time, 'sleep', lambda seconds: None)
+    with moto.mock_aws():
+        boto3.client('s3').create_bucket(Bucket=BUCKET)
+        d = kvm_backup.S3Destination('s3://{:s}/kvm'.format(BUCKET), part_size=5*MiB, workers=3, retries=2)
+        d.mails = mails
+        yield d
+
+
+def get_object(d, key):
+    return d.client.get_object(Bucket=BUCKET, Key=key)['Body'].read()
+
+
+def restore(sparse_map, data):
+    """same as the restore recipe in README.md"""
+    out = bytearray(sparse_map['size'])
+    pos = 0
+    for offset, length in sparse_map['extents']:
+        out[offset:offset + length] = data[pos:pos + length]
+        pos += length
+    return bytes(out)
+
+
+def client_error(code, status):
+    return botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': code},
+                                            'ResponseMetadata': {'HTTPStatusCode': status}}, 'UploadPart')
+
+
+def test_dense_upload_round_trip(dest, tmp_path):
+    data = os.urandom(12*MiB + 123)
+    src = tmp_path / 'disk.qcow2'
+    src.write_bytes(data)
+    dest.copy_file(str(src), 'kvm/vm/t1')
+    assert get_object(dest, 'kvm/vm/t1/disk.qcow2') == data
+    assert dest.listdir('kvm/vm/t1') == ['disk.qcow2']
+
+
+def test_empty_file_has_no_sparsemap(dest, tmp_path):
+    src = tmp_path / 'empty.img'
+    src.write_bytes(b'')
+    dest.copy_file(str(src), 'kvm/vm/t1')
+    assert get_object(dest, 'kvm/vm/t1/empty.img') == b''
+    assert dest.listdir('kvm/vm/t1') == ['empty.img']
+
+
+def test_sparse_upload_restores(dest, tmp_path):
+    first, second = os.urandom(6*MiB), os.urandom(2*MiB)
+    src = tmp_path / 'disk.img'
+    with open(str(src), 'wb') as f:
+        f.write(first)
+        f.seek(64*MiB)
+        f.write(second)
+        f.truncate(128*MiB)
+    size, extents = kvm_backup.get_data_extents(str(src))
+    if sum(length for offset, length in extents) == size:
+        pytest.skip("file system does not report holes")
+    dest.copy_file(str(src), 'kvm/vm/t1')
+    data = get_object(dest, 'kvm/vm/t1/disk.img')
+    sparse_map = json.loads(get_object(dest, 'kvm/vm/t1/disk.img.sparsemap').decode('utf-8'))
+    assert len(data) < 16*MiB
+    assert sparse_map['size'] == 128*MiB
+    assert restore(sparse_map, data) == src.read_bytes()
+
+
+def test_part_failure_aborts_upload(dest, tmp_path, monkeypatch):
+    src = tmp_path / 'disk.qcow2'
+    src.write_bytes(os.urandom(12*MiB))
+    upload_part = dest.client.upload_part
+    attempts = []
+
+    def failing_upload_part(**kwargs):
+        if kwargs['PartNumber'] == 2:
+            attempts.append(kwargs['PartNumber'])
+            raise client_error('InternalError', 500)
+        return upload_part(**kwargs)
+
+    aborted = []
+    abort_multipart_upload = dest.client.abort_multipart_upload
+
+    def spy_abort(**kwargs):
+        aborted.append(kwargs['Key'])
+        return abort_multipart_upload(**kwargs)
+
+    monkeypatch.setattr(dest.client, 'upload_part', failing_upload_part)
+    monkeypatch.setattr(dest.client, 'abort_multipart_upload', spy_abort)
+    with pytest.raises(kvm_backup.CopyFailedException):
+        dest.copy_file(str(src), 'kvm/vm/t1')
+    assert len(attempts) == dest.retries + 1
+    assert aborted == ['kvm/vm/t1/disk.qcow2']
+    assert 'Uploads' not in dest.client.list_multipart_uploads(Bucket=BUCKET)
+    assert dest.listdir('kvm/vm/t1') == []
+
+
+def test_non_retryable_error_fails_at_once(dest, tmp_path, monkeypatch):
+    src = tmp_path / 'disk.qcow2'
+    src.write_bytes(os.urandom(MiB))
+    attempts = []
+
+    def denied_upload_part(**kwargs):
+        attempts.append(kwargs['PartNumber'])
+        raise client_error('AccessDenied', 403)
+
+    monkeypatch.setattr(dest.client, 'upload_part', denied_upload_part)
+    with pytest.raises(kvm_backup.CopyFailedException) as err:
+        dest.copy_file(str(src), 'kvm/vm/t1')
+    assert 'AccessDenied' in str(err.value)
+    assert attempts == [1]
+    assert 'Uploads' not in dest.client.list_multipart_uploads(Bucket=BUCKET)
+
+
+def test_listdir_and_rmtree_retention(dest):
+    for backup in ('2016-01-01T000000', '2016-01-02T000000', '2016-01-03T000000'):
+        dest.write_file('kvm/vm/{:s}/vm.xml'.format(backup), '<domain/>')
+    dest.write_file('kvm/vm/2016-01-02T000000' + kvm_backup.PROFILE_SUFFIX, '{}')
+    dest.write_file('kvm/other/2016-01-01T000000/other.xml', '<domain/>')
+    assert sorted(dest.listdir(dest.join('vm'))) == ['2016-01-01T000000', '2016-01-02T000000',
+                                                     '2016-01-02T000000' + kvm_backup.PROFILE_SUFFIX,
+                                                     '2016-01-03T000000']
+    dest.rmtree(dest.join('vm', '2016-01-01T000000'))
+    dest.remove(dest.join('vm', '2016-01-02T000000' + kvm_backup.PROFILE_SUFFIX))
+    assert sorted(dest.listdir(dest.join('vm'))) == ['2016-01-02T000000', '2016-01-03T000000']
+    assert dest.listdir(dest.join('other')) == ['2016-01-01T000000']